@@ -0,0 +1,243 @@
+"""Classify a loan folder's PDFs before the pipeline touches them.
+
+Samples the first pages of every PDF to decide text-based vs scanned
+(needs OCR) and whether pages carry tables — the downstream extraction
+stages pick their strategy off this classification.
+"""
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+import orjson
+import pdfplumber
+from pdfplumber.table import TableFinder
+from psycopg2.extras import Json, execute_values
+
+from db import get_db_connection
+
+DOCS_ROOT = os.environ.get('MODDA_DOCS_ROOT', 'documents')
+
+
+def detect_tables_in_page(pdf, page_num):
+    """Count tables on one page of an already-open pdfplumber PDF.
+
+    TableFinder stops at geometry (bbox/rows); find_tables would also
+    extract every cell's text, which nothing here reads.
+    """
+    try:
+        tables = TableFinder(pdf.pages[page_num]).tables
+    except Exception:
+        return {'table_count': 0, 'max_rows': 0}
+    return {
+        'table_count': len(tables),
+        'max_rows': max((len(t.rows) for t in tables), default=0),
+    }
+
+
+def analyze_pdf_structure(pdf_path, sample_pages=3, min_text_threshold=50,
+                          file_size=None):
+    """Sample a PDF's first pages for text content and table structure.
+
+    `file_size` lets the caller pass an already-fetched stat result
+    instead of paying a second stat() per file.
+    """
+    result = {
+        'filename': os.path.basename(pdf_path),
+        'file_size': (file_size if file_size is not None
+                      else os.path.getsize(pdf_path)),
+        'page_count': 0,
+        'text_chars': 0,
+        'is_text_based': False,
+        'pages_with_tables': 0,
+        'max_table_rows': 0,
+        'needs_ocr': False,
+    }
+
+    # One pdfplumber pass does both text sampling and table detection;
+    # the file's xref and content streams are parsed once, not twice by
+    # two different libraries.
+    with pdfplumber.open(pdf_path) as pdf:
+        result['page_count'] = len(pdf.pages)
+        pages_to_check = min(sample_pages, result['page_count'])
+        text_chars = 0
+        for i in range(pages_to_check):
+            text = pdf.pages[i].extract_text() or ''
+            text_chars += len(text.strip())
+            # Most text PDFs clear the threshold on page 1; no need to
+            # extract the remaining sampled pages just to re-confirm.
+            if text_chars >= min_text_threshold:
+                break
+        result['text_chars'] = text_chars
+        result['is_text_based'] = text_chars >= min_text_threshold
+
+        # Table detection only makes sense on text PDFs; scanned ones
+        # go to OCR regardless.
+        if result['is_text_based']:
+            for page_idx in range(pages_to_check):
+                # On huge mixed files a single table-bearing page is
+                # minutes of work; once one page has tables the
+                # downstream decision is already made, so don't probe
+                # the remaining samples.
+                if (result['pages_with_tables']
+                        and result['file_size'] > 50_000_000):
+                    break
+                info = detect_tables_in_page(pdf, page_idx)
+                if info['table_count']:
+                    result['pages_with_tables'] += 1
+                result['max_table_rows'] = max(result['max_table_rows'],
+                                               info['max_rows'])
+
+    result['needs_ocr'] = not result['is_text_based']
+    return result
+
+
+def _cache_path(doc_dir):
+    return os.path.join(doc_dir, '1_1_1_analysis.cache.json')
+
+
+def _load_cache(doc_dir):
+    try:
+        with open(_cache_path(doc_dir), 'rb') as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(doc_dir, cache):
+    path = _cache_path(doc_dir)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(orjson.dumps(cache))
+    os.replace(tmp, path)
+
+
+def analyze_loan_documents(doc_dir, sample_pages=3):
+    """Analyze every PDF in the loan folder."""
+    pdf_files = sorted(Path(doc_dir).glob('*.pdf'))
+    results = {
+        'doc_dir': str(doc_dir),
+        'analyzed_at': datetime.now().isoformat(),
+        'details': [],
+    }
+    # Unchanged files keep their result from the last run; the cache
+    # key includes size and mtime so any rewrite invalidates itself.
+    cache = _load_cache(doc_dir)
+    pending = []
+    for pdf_path in pdf_files:
+        st = pdf_path.stat()
+        if st.st_size > 100_000_000:
+            print(f"⚠ {pdf_path.name} is very large; this may be slow")
+        key = f'{pdf_path.name}|{st.st_size}|{int(st.st_mtime)}'
+        cached = cache.get(key)
+        if cached is not None:
+            results['details'].append(cached)
+            print(f"→ {pdf_path.name} unchanged, cached")
+        else:
+            pending.append((key, pdf_path, st.st_size))
+
+    # Each PDF is independent and the work is CPU-bound parsing, so the
+    # folder fans out across cores; worker processes sidestep the GIL.
+    with ProcessPoolExecutor(
+            max_workers=min(os.cpu_count() or 1,
+                            max(len(pending), 1))) as ex:
+        futures = {
+            ex.submit(analyze_pdf_structure, str(pdf_path),
+                      sample_pages=sample_pages,
+                      file_size=size): (key, pdf_path)
+            for key, pdf_path, size in pending
+        }
+        for idx, future in enumerate(as_completed(futures), 1):
+            key, pdf_path = futures[future]
+            try:
+                analysis = future.result()
+            except Exception as e:
+                print(f"✗ [{idx}/{len(pending)}] {pdf_path.name}: {e}")
+                continue
+            results['details'].append(analysis)
+            cache[key] = analysis
+            status = ('✓ text-based' if analysis['is_text_based']
+                      else '⚠ scanned — needs OCR')
+            if analysis['pages_with_tables']:
+                status += (f", tables on {analysis['pages_with_tables']} "
+                           f"sampled pages")
+            # One print per file: each call takes the stdio lock and
+            # flushes, which adds up across a 50-PDF folder.
+            print(f"[{idx}/{len(pending)}] {pdf_path.name} — "
+                  f"{analysis['page_count']} pages, "
+                  f"{analysis['text_chars']} chars sampled, {status}")
+
+    if pending:
+        _save_cache(doc_dir, cache)
+
+    # as_completed returns in finish order; keep the report deterministic.
+    results['details'].sort(key=lambda a: a['filename'])
+
+    text_based = sum(1 for a in results['details'] if a['is_text_based'])
+    results['summary'] = {
+        'total': len(results['details']),
+        'text_based': text_based,
+        'needs_ocr': len(results['details']) - text_based,
+    }
+    print(f"=== {text_based}/{len(results['details'])} PDFs text-based ===")
+    return results
+
+
+def save_results(results, output_path):
+    """Write the analysis record next to the documents for inspection."""
+    with open(output_path, 'wb') as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+
+
+def store_classification(loan_id, results, conn=None):
+    """Upsert each PDF's classification into document_analysis."""
+    if not results['details']:
+        return
+    owned = conn is None
+    if owned:
+        conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            execute_values(
+                cur,
+                """
+                INSERT INTO document_analysis
+                    (loan_id, filename, status, pdf_classification)
+                VALUES %s
+                ON CONFLICT (loan_id, filename) DO UPDATE
+                SET pdf_classification = EXCLUDED.pdf_classification
+                """,
+                [(loan_id, a['filename'], 'pending', Json(a))
+                 for a in results['details']],
+            )
+        conn.commit()
+        print(f"✓ Stored classification for {len(results['details'])} PDFs")
+    finally:
+        if owned:
+            conn.close()
+
+
+def run(loan_id, force=False):
+    """Pipeline entry point."""
+    doc_dir = os.path.join(DOCS_ROOT, loan_id)
+    if not os.path.isdir(doc_dir):
+        print(f"✗ No document folder for loan {loan_id}: {doc_dir}")
+        return
+    results = analyze_loan_documents(doc_dir)
+    save_results(results, os.path.join(doc_dir, '1_1_1_analysis.json'))
+    store_classification(loan_id, results)
+    # Observed counts for the pipeline's stats merge.
+    return {'total_docs': results['summary']['total']}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python analyze_loan_documents.py <loan_id|doc_dir>")
+        sys.exit(1)
+    arg = sys.argv[1]
+    if os.path.isdir(arg):
+        analyze_loan_documents(arg)
+    else:
+        run(arg)
@@ -0,0 +1,34 @@
+"""AWS Bedrock runtime client for the vision-based validators."""
+
+import json
+import os
+
+import boto3
+
+BEDROCK_REGION = os.environ.get('AWS_REGION', 'us-east-1')
+BEDROCK_MODEL_ID = os.environ.get(
+    'MODDA_BEDROCK_MODEL', 'anthropic.claude-opus-4-5-v1:0')
+
+
+class BedrockClient:
+    """Invoke Claude on Bedrock with mixed text/image content."""
+
+    def __init__(self, model=BEDROCK_MODEL_ID, max_tokens=8000,
+                 temperature=0.0):
+        self.client = boto3.client('bedrock-runtime',
+                                   region_name=BEDROCK_REGION)
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+
+    def invoke(self, content):
+        """Send one user message (content-block list) and return the text."""
+        body = json.dumps({
+            'anthropic_version': 'bedrock-2023-05-31',
+            'max_tokens': self.max_tokens,
+            'temperature': self.temperature,
+            'messages': [{'role': 'user', 'content': content}],
+        })
+        response = self.client.invoke_model(modelId=self.model, body=body)
+        payload = json.loads(response['body'].read())
+        return payload['content'][0]['text']
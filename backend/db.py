@@ -0,0 +1,106 @@
+"""Shared Postgres connection helpers for the modda backend scripts."""
+
+import os
+import threading
+import time
+
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+DB_CONFIG = {
+    'host': os.environ.get('MODDA_DB_HOST', 'localhost'),
+    'port': int(os.environ.get('MODDA_DB_PORT', '5432')),
+    'dbname': os.environ.get('MODDA_DB_NAME', 'modda'),
+    'user': os.environ.get('MODDA_DB_USER', 'postgres'),
+    'password': os.environ.get('MODDA_DB_PASSWORD', ''),
+}
+
+# Worst-case concurrent demand: a batch of 8 loans, each running two
+# parallel loaders plus a save connection. Keep headroom above that —
+# getconn on an exhausted ThreadedConnectionPool raises rather than
+# blocks.
+POOL_MAX = int(os.environ.get('MODDA_DB_POOL_MAX', '32'))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Statement names already PREPAREd on an underlying connection, keyed
+# by the raw connection's id(). psycopg2's C connection type can't
+# carry Python attributes, so prepared-ness has to live outside it.
+# Entries are dropped when the connection goes back to the pool: the
+# rollback in close() also discards any statements prepared during the
+# borrow, so the registry and the session stay in sync.
+_prepared_statements = {}
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(1, POOL_MAX, **DB_CONFIG)
+    return _pool
+
+
+class _PooledConnection:
+    """Connection proxy whose close() returns the connection to the pool.
+
+    Keeps every existing `conn = get_db_connection() ... conn.close()`
+    call site working unchanged while the underlying sockets are reused.
+    """
+
+    def __init__(self, conn):
+        object.__setattr__(self, '_conn', conn)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def close(self):
+        conn = self._conn
+        _prepared_statements.pop(id(conn), None)
+        if conn.closed:
+            _get_pool().putconn(conn, close=True)
+            return
+        # Reset session state (open transaction, autocommit flag from
+        # LISTEN users) so the next borrower gets a clean connection.
+        conn.rollback()
+        conn.autocommit = False
+        _get_pool().putconn(conn)
+
+
+def prepare_once(conn, name, statement):
+    """Run a PREPARE at most once per borrow of the connection.
+
+    Repeat calls on the same borrowed connection skip straight to
+    EXECUTE; a fresh borrow re-prepares, which is required anyway since
+    returning to the pool rolls the statement back.
+    """
+    raw = getattr(conn, '_conn', conn)
+    done = _prepared_statements.setdefault(id(raw), set())
+    if name in done:
+        return
+    with conn.cursor() as cur:
+        cur.execute(statement)
+    done.add(name)
+
+
+def get_db_connection(timeout=30.0):
+    """Borrow a connection from the shared pool.
+
+    The returned object behaves like a psycopg2 connection; close()
+    returns it to the pool instead of tearing down the socket, so the
+    scripts' many short-lived connections stop paying TCP/TLS/auth setup
+    each time. If the pool is momentarily exhausted the call waits for a
+    connection to come back rather than failing the caller, up to
+    `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return _PooledConnection(_get_pool().getconn())
+        except PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
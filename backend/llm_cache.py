@@ -0,0 +1,42 @@
+"""Disk-backed exact-match cache for deterministic LLM calls.
+
+At temperature 0 an identical payload yields an identical response, so
+development/test reruns can skip the API round-trip entirely. Entries
+live under ~/.cache/modda/llm/<key[:2]>/<key>.json.
+"""
+
+import hashlib
+import json
+import os
+
+CACHE_DIR = os.environ.get('MODDA_LLM_CACHE',
+                           os.path.expanduser('~/.cache/modda/llm'))
+
+
+def make_key(payload):
+    """SHA-256 of the canonically serialized payload dict."""
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _path(key):
+    return os.path.join(CACHE_DIR, key[:2], key + '.json')
+
+
+def get(key):
+    """Return the cached value for key, or None on miss/corruption."""
+    try:
+        with open(_path(key)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def set(key, value):
+    """Store value under key (atomic write)."""
+    path = _path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmp, path)
@@ -0,0 +1,4 @@
+-- Support upserting verification results instead of DELETE+INSERT churn.
+-- evidence_files holds exactly one row per (loan_id, attribute_id).
+ALTER TABLE evidence_files
+    ADD CONSTRAINT evidence_files_loan_attr_key UNIQUE (loan_id, attribute_id);
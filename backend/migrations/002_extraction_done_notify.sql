@@ -0,0 +1,23 @@
+-- Emit a NOTIFY when the last outstanding deep extraction for a loan lands,
+-- so waiters don't have to poll aggregate counts.
+CREATE OR REPLACE FUNCTION notify_loan_extraction_done() RETURNS trigger AS $$
+BEGIN
+    IF NEW.individual_analysis IS NOT NULL THEN
+        IF NOT EXISTS (
+            SELECT 1 FROM document_analysis
+            WHERE loan_id = NEW.loan_id
+              AND status != 'duplicate'
+              AND individual_analysis IS NULL
+              AND id != NEW.id
+        ) THEN
+            PERFORM pg_notify('loan_extraction_done', NEW.loan_id::text);
+        END IF;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS document_analysis_extraction_done ON document_analysis;
+CREATE TRIGGER document_analysis_extraction_done
+    AFTER UPDATE OF individual_analysis ON document_analysis
+    FOR EACH ROW EXECUTE FUNCTION notify_loan_extraction_done();
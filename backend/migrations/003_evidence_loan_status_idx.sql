@@ -0,0 +1,3 @@
+-- Back the verification summary (and any loan/status filter) with an index.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS evidence_loan_status_idx
+    ON evidence_files (loan_id, verification_status);
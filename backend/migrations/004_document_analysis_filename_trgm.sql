@@ -0,0 +1,11 @@
+-- Leading-wildcard filename matches in load_source_documents can't use a
+-- btree; a trigram GIN index makes ILIKE '%pattern%' index-accelerated.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS document_analysis_filename_trgm
+    ON document_analysis USING gin (filename gin_trgm_ops);
+
+-- The extraction-complete checks and the financial-document union branch
+-- only ever look at analyzed rows.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS document_analysis_loan_analyzed_idx
+    ON document_analysis (loan_id) WHERE individual_analysis IS NOT NULL;
@@ -0,0 +1,16 @@
+-- get_loan_stats filters every count by loan_id plus either status or a
+-- NULL test; these indexes keep the single-statement stats query off seq
+-- scans as document_analysis grows.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_da_loan_status
+    ON document_analysis (loan_id, status);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_da_loan_vlm
+    ON document_analysis (loan_id) WHERE vlm_analysis IS NOT NULL;
+
+-- Backs the financial-docs FILTER on the version_metadata fields.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_da_loan_financial
+    ON document_analysis (loan_id,
+                          (version_metadata->>'financial_category'),
+                          (version_metadata->>'classification'));
+
+ANALYZE document_analysis;
@@ -0,0 +1,540 @@
+"""Two-phase MT360 validation against the raw loan PDFs.
+
+Phase 1 asks Claude to plan which document answers which MT360 field,
+phase 2 validates each planned group against that document's pages, and
+a final semantic pass tries to place any fields the plan left unmapped.
+"""
+
+import base64
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+
+import orjson
+from pdf2image import convert_from_path
+
+from bedrock_config import BedrockClient
+from db import get_db_connection
+
+# One BedrockClient per thread: construction parses boto3's model data
+# and builds a TLS pool, which is far too expensive to repeat per phase.
+_BEDROCK_LOCAL = threading.local()
+
+
+def _bedrock():
+    client = getattr(_BEDROCK_LOCAL, 'client', None)
+    if client is None:
+        client = BedrockClient()
+        _BEDROCK_LOCAL.client = client
+    return client
+
+
+# Process-wide cap on in-flight Bedrock calls: the phase-2 pool can
+# otherwise fan out past the account's rate limit and throttle itself.
+_BEDROCK_SEM = threading.Semaphore(
+    int(os.environ.get('BEDROCK_CONCURRENCY', '4')))
+
+_RETRYABLE_CODES = frozenset((
+    'ThrottlingException', 'TooManyRequestsException',
+    'ServiceUnavailableException', 'ModelTimeoutException',
+    'InternalServerException',
+))
+
+
+def _invoke_with_retry(content, attempts=5):
+    """Invoke Bedrock with exponential backoff on throttling/5xx.
+
+    A transient 429 no longer fails the whole loan. Full jitter keeps
+    concurrent workers from retrying in lockstep.
+    """
+    base = 1.0
+    for attempt in range(1, attempts + 1):
+        try:
+            with _BEDROCK_SEM:
+                return _bedrock().invoke(content)
+        except Exception as exc:
+            code = getattr(exc, 'response', {}).get('Error', {}).get('Code')
+            if code not in _RETRYABLE_CODES or attempt == attempts:
+                raise
+            delay = min(base, 30.0) * random.random()
+            print(f"⚠ Bedrock {code}, retry {attempt}/{attempts - 1} "
+                  f"in {delay:.1f}s")
+            time.sleep(delay)
+            base *= 2
+
+
+_FENCE_RE = re.compile(r'```(?:json)?\s*(.*?)```', re.DOTALL)
+
+
+def _extract_json(text):
+    """Parse a model response: bare JSON first, else the fenced block."""
+    text = text.strip()
+    try:
+        return orjson.loads(text)
+    except ValueError:
+        match = _FENCE_RE.search(text)
+        if match is None:
+            raise
+        return orjson.loads(match.group(1).strip())
+
+
+# Address post-processing patterns, compiled once instead of per field.
+# Address-type fields, matched in one C-level scan instead of a Python
+# any() over substrings per result.
+_ADDR_FIELD_RE = re.compile(
+    r'property subject address|current subject address'
+    r'|subject address|mailing address')
+
+_STATE_ZIP_RE = re.compile(r',?\s*[A-Z]{2}\s+(\d{5})')
+_MT360_STATE_RE = re.compile(r'\s([A-Z]{2})\s+\d{5}')
+_STATE_ZIP_SUFFIX_RE = re.compile(r',?\s*[A-Z]{2}\s+\d{5}(-\d{4})?\s*$')
+
+
+# Rasterization is the dominant non-LLM cost and identical documents
+# recur across phases and across runs, so rendered pages are cached
+# content-addressed: in memory for this run, gzip-compressed JSON on
+# disk for the next one.
+_PDF_B64_DIR = os.environ.get('MODDA_PDF_CACHE',
+                              os.path.join('.cache', 'pdf_b64'))
+_PDF_B64_MEM = {}
+_PDF_HASHES = {}
+
+
+def _pdf_digest(pdf_path):
+    """SHA-256 of the file, memoized by (path, mtime, size)."""
+    st = os.stat(pdf_path)
+    stat_key = (os.path.abspath(pdf_path), st.st_mtime, st.st_size)
+    digest = _PDF_HASHES.get(stat_key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(pdf_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        _PDF_HASHES[stat_key] = digest
+    return digest
+
+
+# 110 dpi JPEG at quality 75 reads cleanly for these forms and cuts
+# upload size and image-token billing roughly in half versus 150/85.
+DEFAULT_QUALITY_PROFILE = {'dpi': 110, 'format': 'JPEG', 'quality': 75}
+
+# Pages that still encode larger than this get one re-encode at lower
+# quality to cap the per-page payload.
+_PAGE_BYTE_CAP = 500 * 1024
+
+
+def iter_pdf_pages_b64(pdf_path, max_pages=100, quality_profile=None):
+    """Yield (page_no, b64) for a PDF's pages, 1-based (content-cached).
+
+    Streaming keeps peak memory at one rasterized page at a time on the
+    render path: each PIL bitmap is dropped as soon as its JPEG is
+    encoded, instead of a full list of bitmaps plus a full list of
+    base64 strings coexisting.
+    """
+    profile = quality_profile or DEFAULT_QUALITY_PROFILE
+    key = (f"{_pdf_digest(pdf_path)}_{max_pages}"
+           f"_{profile['dpi']}_{profile['format']}_{profile['quality']}")
+    images = _PDF_B64_MEM.get(key)
+    if images is not None:
+        yield from enumerate(images, start=1)
+        return
+
+    disk_path = os.path.join(_PDF_B64_DIR, f'{key}.json.gz')
+    try:
+        with gzip.open(disk_path, 'rt') as f:
+            images = json.load(f)
+    except (OSError, ValueError):
+        images = None
+
+    if images is None:
+        # Poppler renders page ranges in parallel workers; on long PDFs
+        # this scales nearly linearly with cores.
+        pages = convert_from_path(pdf_path, dpi=profile['dpi'], first_page=1,
+                                  last_page=max_pages,
+                                  thread_count=os.cpu_count() or 1)
+        images = []
+        for i, page in enumerate(pages):
+            buffer = BytesIO()
+            page.save(buffer, format=profile['format'],
+                      quality=profile['quality'])
+            if buffer.tell() > _PAGE_BYTE_CAP:
+                buffer = BytesIO()
+                page.save(buffer, format=profile['format'],
+                          quality=max(profile['quality'] - 20, 40))
+            # getbuffer() is a zero-copy view of the JPEG bytes; with
+            # decode('ascii') that's two fewer full-size copies per page.
+            b64 = base64.b64encode(buffer.getbuffer()).decode('ascii')
+            pages[i] = None  # free the bitmap before rendering moves on
+            images.append(b64)
+            yield i + 1, b64
+        os.makedirs(_PDF_B64_DIR, exist_ok=True)
+        tmp = f'{disk_path}.{os.getpid()}.tmp'
+        with gzip.open(tmp, 'wt') as f:
+            json.dump(images, f)
+        os.replace(tmp, disk_path)
+        _PDF_B64_MEM[key] = images
+        return
+
+    _PDF_B64_MEM[key] = images
+    yield from enumerate(images, start=1)
+
+
+# Listing + manifest parse cached per (doc_dir, dir mtime, manifest
+# mtime): repeat validations against the same directory skip the rescan.
+_docs_cache = {}
+
+
+def get_all_documents_with_summaries(doc_dir):
+    """List the loan PDFs with their manifest titles and summaries."""
+    manifest_path = os.path.join(doc_dir, 'documents.json')
+    try:
+        manifest_mtime = os.path.getmtime(manifest_path)
+    except OSError:
+        manifest_mtime = 0
+    cache_key = (doc_dir, os.path.getmtime(doc_dir), manifest_mtime)
+    cached = _docs_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    manifest = {}
+    if manifest_mtime:
+        with open(manifest_path, 'rb') as f:
+            manifest = orjson.loads(f.read())
+
+    # scandir yields name and path in one syscall pass; directories like
+    # deep_json/ and non-PDF siblings drop out without extra stat calls.
+    entries = [e for e in os.scandir(doc_dir)
+               if e.name.endswith('.pdf') and e.is_file()]
+    entries.sort(key=lambda e: e.name)
+
+    documents = []
+    manifest_get = manifest.get
+    for e in entries:
+        entry = manifest_get(e.name, {})
+        title = entry.get('title')
+        if title is None:
+            title = e.name.replace('.pdf', '').replace('_', ' ').title()
+        documents.append({
+            'filename': e.name,
+            'path': e.path,
+            'title': title,
+            'summary': entry.get('summary', ''),
+        })
+    _docs_cache[cache_key] = documents
+    return documents
+
+
+def get_mt360_data(loan_id):
+    """Load the MT360 snapshot values for the loan."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT fa.attribute_label, ed.extracted_value
+                FROM extracted_1008_data ed
+                JOIN form_1008_attributes fa ON fa.id = ed.attribute_id
+                WHERE ed.loan_id = %s
+                  AND ed.extracted_value IS NOT NULL
+                """,
+                (loan_id,),
+            )
+            return dict(cur.fetchall())
+    finally:
+        conn.close()
+
+
+# Phase-1 plans are deterministic in practice (same fields + same doc
+# titles → same assignment), so they persist in a small SQLite cache
+# and repeat loans on an unchanged document set skip the round-trip.
+_PHASE1_DB = os.environ.get('MODDA_PHASE1_CACHE',
+                            os.path.join('.cache', 'phase1.db'))
+
+
+def _phase1_cache():
+    os.makedirs(os.path.dirname(_PHASE1_DB), exist_ok=True)
+    conn = sqlite3.connect(_PHASE1_DB)
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS plans (key TEXT PRIMARY KEY, plan_json TEXT)')
+    return conn
+
+
+def phase1_select_documents(mt360_data, documents):
+    """Ask Claude to assign each MT360 field to its best document."""
+    cache_key = hashlib.sha256(json.dumps(
+        [sorted(mt360_data), sorted((d['filename'], d['title'])
+                                    for d in documents)],
+    ).encode()).hexdigest()
+    cache = _phase1_cache()
+    try:
+        row = cache.execute(
+            'SELECT plan_json FROM plans WHERE key = ?', (cache_key,)
+        ).fetchone()
+        if row:
+            plan = json.loads(row[0])
+            print(f"✓ Phase 1 plan from cache: "
+                  f"{len(plan.get('groups', []))} document groups")
+            return plan
+    finally:
+        cache.close()
+
+    # Generators: join consumes the lines as they're formatted, with no
+    # intermediate list of per-document strings.
+    doc_manifest = "\n".join(
+        f"{i + 1}. {d['filename']} - \"{d['title']}\""
+        + (f" — {d['summary']}" if d['summary'] else "")
+        for i, d in enumerate(documents))
+    fields_text = "\n".join(f"- {name}" for name in sorted(mt360_data))
+
+    prompt = f"""You are planning a document-based validation of loan system fields.
+
+## AVAILABLE DOCUMENTS:
+{doc_manifest}
+
+## FIELDS TO VALIDATE:
+{fields_text}
+
+Assign every field to the single document most likely to state its
+value. Fields no document can answer go in "unmapped".
+Return ONLY JSON:
+```json
+{{"groups": [{{"document": "<filename>", "fields": ["..."]}}],
+  "unmapped": ["..."]}}
+```"""
+
+    response_text = _invoke_with_retry([{'type': 'text', 'text': prompt}])
+    plan = _extract_json(response_text)
+
+    cache = _phase1_cache()
+    try:
+        with cache:
+            cache.execute(
+                'INSERT OR REPLACE INTO plans VALUES (?, ?)',
+                (cache_key, json.dumps(plan)))
+    finally:
+        cache.close()
+
+    print(f"✓ Phase 1: {len(plan.get('groups', []))} document groups, "
+          f"{len(plan.get('unmapped', []))} unmapped fields")
+    return plan
+
+
+# The Lender Loan Information sections phase 2 actually reads.
+SECTION_MARKERS = ('Section L2', 'Section L3', 'Section L4',
+                   'Title will be held')
+
+
+def _locate_section_pages(pdf_path, section_markers=SECTION_MARKERS):
+    """1-based page numbers whose text mentions any section marker.
+
+    Text extraction is orders of magnitude cheaper than shipping the
+    page as an image; returns None when pdfplumber is unavailable or
+    the text layer is unusable, in which case callers keep every page.
+    """
+    try:
+        import pdfplumber
+    except ImportError:
+        return None
+    pages = set()
+    try:
+        with pdfplumber.open(pdf_path) as pdf:
+            for number, page in enumerate(pdf.pages, start=1):
+                text = page.extract_text() or ''
+                if any(marker in text for marker in section_markers):
+                    pages.add(number)
+    except Exception:
+        return None
+    return pages or None
+
+
+def phase2_validate_with_pdfs(group, mt360_data, documents,
+                              docs_by_filename=None):
+    """Validate one group of fields against its document's pages."""
+    if docs_by_filename is None:
+        docs_by_filename = {d['filename']: d for d in documents}
+    doc_filename = group['document']
+    doc = docs_by_filename.get(doc_filename)
+    if doc is None:
+        print(f"⚠ Planned document not on disk: {doc_filename}")
+        return [{'mt360_field_name': f, 'status': 'NOT_FOUND',
+                 'notes': 'planned document missing'} for f in group['fields']]
+
+    # Section-scoped documents only need the pages carrying their
+    # sections; a cheap text pass finds them so the rest never bill
+    # image tokens.
+    section_pages = None
+    if 'lender' in doc_filename.lower():
+        section_pages = _locate_section_pages(doc['path'])
+
+    fields_text = "\n".join(
+        f"- {name}: {mt360_data.get(name)}" for name in group['fields'])
+    prompt = f"""Validate these loan system values against the attached document pages.
+
+## FIELDS (system values):
+{fields_text}
+
+For each field report MATCH, MISMATCH, or NOT_FOUND, with the document
+value and the page it appears on.
+Return ONLY JSON:
+```json
+[{{"mt360_field_name": "...", "mt360_value": "...",
+   "document_value": "...", "status": "MATCH", "page": 1, "notes": null}}]
+```"""
+
+    # Pages stream straight into content; no separate images list holds
+    # a second set of references to the base64 strings.
+    # No page limit — accuracy is priority.
+    content = []
+    for number, b64 in iter_pdf_pages_b64(doc['path'], max_pages=100):
+        if section_pages and number not in section_pages:
+            continue
+        content.append(
+            {'type': 'image',
+             'source': {'type': 'base64', 'media_type': 'image/jpeg',
+                        'data': b64}})
+    content.append({'type': 'text', 'text': prompt})
+
+    response_text = _invoke_with_retry(content)
+    results = _extract_json(response_text)
+
+    # Address fields: formatting noise (trailing state/ZIP, abbreviation
+    # differences) should not count as a mismatch when the street lines
+    # agree.
+    for result in results:
+        field_name = result.get('mt360_field_name', '').lower()
+        if _ADDR_FIELD_RE.search(field_name):
+            doc_value = str(result.get('document_value') or '')
+            mt360_value = str(result.get('mt360_value') or '')
+            state_zip = _STATE_ZIP_RE.search(doc_value)
+            mt360_state = _MT360_STATE_RE.search(mt360_value)
+            doc_street = _STATE_ZIP_SUFFIX_RE.sub('', doc_value)
+            mt_street = _STATE_ZIP_SUFFIX_RE.sub('', mt360_value)
+            if (result.get('status') == 'MISMATCH'
+                    and doc_street.strip().lower() == mt_street.strip().lower()
+                    and (not state_zip or not mt360_state
+                         or state_zip.group(1) in mt360_value)):
+                result['status'] = 'MATCH'
+                result['notes'] = 'address formatting difference only'
+    return results
+
+
+def semantic_match_unmapped(unmapped_fields, mt360_data, documents):
+    """Last pass: look for unmapped fields anywhere in the URLA."""
+    if not unmapped_fields:
+        return []
+    # One pass over the documents instead of two next() scans.
+    urla = None
+    for d in documents:
+        name = d['filename'].lower()
+        if 'urla' not in name:
+            continue
+        if 'final' in name:
+            urla = d
+            break
+        if urla is None:
+            urla = d
+    if urla is None:
+        return [{'mt360_field_name': f, 'status': 'NOT_FOUND',
+                 'notes': 'no URLA available'} for f in unmapped_fields]
+
+    fields_text = "\n".join(
+        f"- {name}: {mt360_data.get(name)}" for name in unmapped_fields)
+    prompt = f"""These loan system fields had no obvious source document. Search the
+attached URLA pages for anything semantically equivalent.
+
+## FIELDS (system values):
+{fields_text}
+
+Return ONLY JSON:
+```json
+[{{"mt360_field_name": "...", "mt360_value": "...",
+   "document_value": "...", "status": "MATCH", "page": 1, "notes": null}}]
+```"""
+
+    content = [
+        {'type': 'image',
+         'source': {'type': 'base64', 'media_type': 'image/jpeg',
+                    'data': b64}}
+        for _number, b64 in iter_pdf_pages_b64(urla['path'], max_pages=100)
+    ]
+    content.append({'type': 'text', 'text': prompt})
+
+    response_text = _invoke_with_retry(content)
+    return _extract_json(response_text)
+
+
+def smart_validate_mt360_v2(loan_id, doc_dir):
+    """Run the full plan → validate → semantic-match pipeline."""
+    print(f"=== MT360 validation v2 for loan {loan_id} ===")
+    mt360_data = get_mt360_data(loan_id)
+    if not mt360_data:
+        print("✗ No MT360 data found")
+        return []
+    documents = get_all_documents_with_summaries(doc_dir)
+    if not documents:
+        print("✗ No documents found")
+        return []
+
+    docs_by_filename = {d['filename']: d for d in documents}
+
+    plan = phase1_select_documents(mt360_data, documents)
+    doc_groups = plan.get('groups', [])
+    unmapped = plan.get('unmapped', [])
+
+    # Each group's validation is an independent Bedrock round-trip plus
+    # its own rasterization; running them concurrently turns
+    # sum-of-latencies into roughly max-of-latencies.
+    all_results = []
+    with ThreadPoolExecutor(max_workers=max(len(doc_groups), 1)) as ex:
+        futures = {
+            ex.submit(phase2_validate_with_pdfs, group, mt360_data,
+                      documents, docs_by_filename): group['document']
+            for group in doc_groups
+        }
+        for future in as_completed(futures):
+            print(f"✓ Validated against {futures[future]}")
+            all_results.extend(future.result())
+
+    # One semantic pass covers both the fields the plan couldn't place
+    # and anything phase 2 reported NOT_FOUND; the URLA pages it needs
+    # come straight from the content cache phase 2 already populated, so
+    # the retry costs one Bedrock call and no rasterization.
+    retry_fields = list(unmapped) + [
+        r['mt360_field_name'] for r in all_results
+        if r.get('status') == 'NOT_FOUND' and r.get('mt360_field_name')
+    ]
+    if retry_fields:
+        semantic = semantic_match_unmapped(retry_fields, mt360_data,
+                                           documents)
+        by_field = {r.get('mt360_field_name'): r for r in semantic}
+        all_results = [
+            by_field.pop(r.get('mt360_field_name'), r)
+            if r.get('status') == 'NOT_FOUND' else r
+            for r in all_results
+        ]
+        all_results.extend(by_field.values())
+
+    matches = sum(1 for r in all_results if r.get('status') == 'MATCH')
+    print(f"=== {matches}/{len(all_results)} fields match ===")
+    for r in all_results:
+        if r.get('status') != 'MATCH':
+            print(f"  ✗ {r.get('mt360_field_name')}: {r.get('status')} "
+                  f"({r.get('notes')})")
+    return all_results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: python mt360_validator.py <loan_id> <doc_dir>")
+        sys.exit(1)
+    smart_validate_mt360_v2(sys.argv[1], sys.argv[2])
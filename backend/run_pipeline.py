@@ -0,0 +1,278 @@
+"""Run the full document pipeline for a loan, stage by stage.
+
+Each stage is a standalone script in this directory exposing a
+`run(loan_id)` entry point. The pipeline imports and runs them in order,
+logging loan statistics before and after.
+"""
+
+import argparse
+import importlib
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from db import get_db_connection, prepare_once
+
+STAGES = {
+    'snapshot': {
+        'script': 'extract_snapshot.py',
+        'description': 'Extract MT360 field values from the UI snapshot',
+        'consumes': [],
+        'produces': ['mt360_fields'],
+    },
+    'analyze': {
+        'script': 'analyze_loan_documents.py',
+        'description': 'Classify PDFs as text-based or needing OCR',
+        'consumes': [],
+        'produces': ['pdf_classification'],
+    },
+    'dedup': {
+        'script': 'dedup_documents.py',
+        'description': 'Mark duplicate documents',
+        'consumes': ['pdf_classification'],
+        'produces': ['status'],
+    },
+    'classify': {
+        'script': 'classify_documents.py',
+        'description': 'Classify document types with the VLM',
+        'consumes': ['pdf_classification'],
+        'produces': ['vlm_analysis'],
+    },
+    'version': {
+        'script': 'version_documents.py',
+        'description': 'Group document versions (initial/final)',
+        'consumes': ['vlm_analysis'],
+        'produces': ['version_metadata'],
+    },
+    'financial': {
+        'script': 'tag_financial_documents.py',
+        'description': 'Tag financially relevant documents',
+        'consumes': ['vlm_analysis'],
+        'produces': ['financial_tags'],
+    },
+    'deep-extract': {
+        'script': 'deep_extract.py',
+        'description': 'Deep-extract structured data from each document',
+        'consumes': ['status', 'version_metadata', 'financial_tags'],
+        'produces': ['individual_analysis'],
+    },
+    'evidence': {
+        'script': 'verify_attributes.py',
+        'description': 'Verify 1008 attributes against source documents',
+        'consumes': ['mt360_fields', 'individual_analysis'],
+        'produces': ['evidence_files'],
+    },
+    'second-pass': {
+        'script': 'second_pass_verification.py',
+        'description': 'Re-verify attributes that failed the first pass',
+        'consumes': ['evidence_files'],
+        'produces': ['second_pass_results'],
+    },
+}
+
+def _stage_dependencies():
+    """Map each stage to the stages producing the artifacts it consumes."""
+    producers = {}
+    for name, cfg in STAGES.items():
+        for artifact in cfg['produces']:
+            producers.setdefault(artifact, set()).add(name)
+    return {
+        name: {producer
+               for artifact in cfg['consumes']
+               for producer in producers.get(artifact, ())}
+        for name, cfg in STAGES.items()
+    }
+
+
+def _topo_levels(dependencies):
+    """Group stages into dependency levels via Kahn's algorithm.
+
+    Stages within a level have no dependencies on each other and can run
+    concurrently; levels run in order.
+    """
+    remaining = {name: set(deps) for name, deps in dependencies.items()}
+    levels = []
+    while remaining:
+        ready = sorted(name for name, deps in remaining.items() if not deps)
+        if not ready:
+            raise ValueError(f'Stage dependency cycle among: {sorted(remaining)}')
+        levels.append(ready)
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return levels
+
+
+# Derived once at import: parallel schedule plus the flattened serial order.
+STAGE_LEVELS = _topo_levels(_stage_dependencies())
+STAGE_ORDER = [stage for level in STAGE_LEVELS for stage in level]
+
+
+# Timestamps have one-second resolution, so cache the formatted string
+# per second instead of paying strftime on every log line.
+_LAST_TS = [0, '']
+
+
+def log(message):
+    now = int(time.time())
+    if now != _LAST_TS[0]:
+        _LAST_TS[:] = [now, time.strftime('%Y-%m-%d %H:%M:%S',
+                                          time.localtime(now))]
+    print(f"[{_LAST_TS[1]}] {message}")
+
+
+_STATS_SQL = """
+    WITH da AS (
+        SELECT COUNT(*) AS total_docs,
+               COUNT(*) FILTER (WHERE status != 'duplicate') AS unique_docs,
+               COUNT(*) FILTER (WHERE vlm_analysis IS NOT NULL) AS docs_with_vlm,
+               COUNT(*) FILTER (WHERE individual_analysis IS NOT NULL) AS docs_extracted,
+               COUNT(*) FILTER (
+                   WHERE status != 'duplicate'
+                     AND (version_metadata->>'financial_category' = 'FINANCIAL'
+                          OR version_metadata->>'classification' = 'FINANCIAL')
+               ) AS financial_docs
+        FROM document_analysis WHERE loan_id = $1
+    ), ef AS (
+        SELECT COUNT(*) AS evidence_rows
+        FROM evidence_files WHERE loan_id = $1
+    ), cs AS (
+        SELECT COUNT(*) AS calc_steps,
+               COUNT(DISTINCT attribute_id) AS attrs_with_steps
+        FROM calculation_steps WHERE loan_id = $1
+    ), fa AS (
+        SELECT COUNT(*) AS total_attributes FROM form_1008_attributes
+    )
+    SELECT da.total_docs, da.unique_docs, da.docs_with_vlm,
+           da.docs_extracted, da.financial_docs,
+           ef.evidence_rows, cs.calc_steps, cs.attrs_with_steps,
+           fa.total_attributes
+    FROM da, ef, cs, fa
+"""
+
+
+def get_loan_stats(loan_id, conn=None):
+    """Collect per-loan pipeline statistics in a single round-trip.
+
+    On a reused connection the statement is server-prepared once, so
+    repeat calls skip the parse/plan step entirely.
+    """
+    owned = conn is None
+    if owned:
+        conn = get_db_connection()
+    try:
+        prepare_once(conn, 'loan_stats',
+                     'PREPARE loan_stats (text) AS ' + _STATS_SQL)
+        with conn.cursor() as cur:
+            cur.execute('EXECUTE loan_stats(%s)', (loan_id,))
+            row = cur.fetchone()
+    finally:
+        if owned:
+            conn.close()
+    keys = ['total_docs', 'unique_docs', 'docs_with_vlm', 'docs_extracted',
+            'financial_docs', 'evidence_rows', 'calc_steps',
+            'attrs_with_steps', 'total_attributes']
+    return dict(zip(keys, row))
+
+
+def run_stage(stage, loan_id, force=False):
+    """Import and run a single stage's script.
+
+    Returns (ok, stats): stages may return a dict of observed counts from
+    run(), which the pipeline aggregates instead of re-counting in SQL.
+    """
+    config = STAGES[stage]
+    script_name = config['script'].replace('.py', '')
+    log(f"→ Stage '{stage}': {config['description']}")
+    try:
+        module = importlib.import_module(script_name)
+        result = module.run(loan_id, force=force)
+        log(f"✓ Stage '{stage}' complete")
+        return True, result if isinstance(result, dict) else None
+    except Exception:
+        log(f"✗ Stage '{stage}' failed")
+        traceback.print_exc()
+        return False, None
+
+
+def preload_stage_modules():
+    """Import every stage script up front, overlapping the disk I/O.
+
+    Keeps the first stage's critical section from paying import costs;
+    sys.modules makes the later per-stage imports hits.
+    """
+    names = [cfg['script'].replace('.py', '') for cfg in STAGES.values()]
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        for future in [ex.submit(importlib.import_module, n) for n in names]:
+            try:
+                future.result()
+            except ImportError:
+                pass  # surfaced properly when the stage actually runs
+
+
+def run_pipeline(loan_id, force=False, only_stage=None):
+    """Run every stage (or one stage) for a loan."""
+    log(f"=== Pipeline start for loan {loan_id} ===")
+    preload_stage_modules()
+    # One connection for the whole run, so the stats statement is planned
+    # once and the final stats call is EXECUTE-only.
+    stats_conn = get_db_connection()
+    stats = get_loan_stats(loan_id, conn=stats_conn)
+    log(f"Initial loan statistics: {stats}")
+
+    merged = dict(stats)
+    complete = True  # every stage reported counts; no SQL re-count needed
+    if only_stage:
+        ok, stage_stats = run_stage(only_stage, loan_id, force=force)
+        if not ok:
+            log(f"Pipeline aborted at stage '{only_stage}'")
+            stats_conn.close()
+            return False
+        if stage_stats:
+            merged.update(stage_stats)
+        else:
+            complete = False
+    else:
+        # Stages in the same dependency level are independent; the heavy
+        # ones are VLM/DB-bound, so threads overlap their I/O waits.
+        for level in STAGE_LEVELS:
+            with ThreadPoolExecutor(max_workers=len(level)) as ex:
+                futures = {ex.submit(run_stage, stage, loan_id, force): stage
+                           for stage in level}
+                failed = []
+                for future in as_completed(futures):
+                    ok, stage_stats = future.result()
+                    if not ok:
+                        failed.append(futures[future])
+                    elif stage_stats:
+                        merged.update(stage_stats)
+                    else:
+                        complete = False
+            if failed:
+                log(f"Pipeline aborted; failed stages: {', '.join(sorted(failed))}")
+                stats_conn.close()
+                return False
+
+    # Stage-reported counts are ground truth when complete; only re-count
+    # in SQL when some stage didn't report.
+    stats = merged if complete else get_loan_stats(loan_id, conn=stats_conn)
+    stats_conn.close()
+    log(f"Final loan statistics: {stats}")
+    log("=== Pipeline complete ===")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the loan document pipeline')
+    parser.add_argument('loan_id')
+    parser.add_argument('--stage', choices=STAGE_ORDER,
+                        help='Run a single stage only')
+    parser.add_argument('--force', action='store_true',
+                        help='Re-run stages even if their outputs exist')
+    args = parser.parse_args()
+    run_pipeline(args.loan_id, force=args.force, only_stage=args.stage)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+"""Verify extracted MT360/1008 attributes in one shot against source documents.
+
+Lighter-weight sibling of verify_attributes.py used by the pipeline's
+re-verify path: one prompt over the priority documents, one save.
+"""
+
+import csv
+import io
+import json
+import sys
+
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.extras import RealDictCursor, execute_batch
+
+from db import get_db_connection
+from verify_attributes import ATTRIBUTE_DEFINITIONS
+from vlm_client import VLMClient
+
+# Keyword router: which document classes can evidence which attributes.
+# Keys are matched as substrings of the lowercased attribute label.
+ATTR_DOC_HINTS = {
+    'p&i': ('closing_disclosure', 'promissory_note', 'mortgage_loan_statement'),
+    'principal': ('closing_disclosure', 'promissory_note',
+                  'mortgage_loan_statement'),
+    'loan amount': ('closing_disclosure', 'promissory_note', 'loan_estimate'),
+    'ltv': ('closing_disclosure', 'appraisal_report', 'loan_estimate'),
+    'value': ('appraisal_report', 'purchase_agreement'),
+    'price': ('purchase_agreement', 'closing_disclosure'),
+    'income': ('w2', 'paystub', 'tax_return', 'bank_statement'),
+    'obligation': ('credit_report', 'mortgage_loan_statement'),
+    'insurance': ('hazard_insurance', 'mortgage_insurance',
+                  'closing_disclosure'),
+    'rate': ('promissory_note', 'closing_disclosure', 'loan_estimate'),
+    'tax': ('closing_disclosure', 'tax_return'),
+}
+
+# Document classes that settle most attributes, most useful first.
+PRIORITY_PATTERNS = [
+    'closing_disclosure',
+    'promissory_note',
+    'mortgage_loan_statement',
+    'appraisal_report',
+    'loan_estimate',
+    'hazard_insurance',
+]
+
+
+def load_attributes_to_verify(loan_id):
+    """Load the attributes that still need verification."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT fa.id, fa.attribute_label, ed.extracted_value
+                FROM form_1008_attributes fa
+                JOIN extracted_1008_data ed ON ed.attribute_id = fa.id
+                WHERE ed.loan_id = %s
+                  AND ed.extracted_value IS NOT NULL
+                  AND LOWER(TRIM(ed.extracted_value::text)) != 'none'
+                ORDER BY fa.id
+                """,
+                (loan_id,),
+            )
+            return [
+                {'id': row['id'],
+                 'label': row['attribute_label'],
+                 'expected': row['extracted_value'],
+                 'definition': ATTRIBUTE_DEFINITIONS.get(
+                     row['attribute_label'], 'Standard 1008 field')}
+                for row in cur.fetchall()
+            ]
+    finally:
+        conn.close()
+
+
+def load_source_documents(loan_id):
+    """Load analysis snippets for the priority documents, then filler docs."""
+    conn = get_db_connection()
+    docs = {}
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            # One statement for every priority pattern, keeping the
+            # two-documents-per-pattern cap via a window function.
+            cur.execute(
+                """
+                SELECT filename,
+                       LEFT(individual_analysis::text, 5000) AS analysis_text
+                FROM (
+                    SELECT da.filename, da.individual_analysis,
+                           row_number() OVER (
+                               PARTITION BY p.pattern ORDER BY da.id
+                           ) AS rn
+                    FROM document_analysis da
+                    JOIN unnest(%s::text[]) AS p(pattern)
+                      ON da.filename ILIKE '%%' || p.pattern || '%%'
+                    WHERE da.loan_id = %s
+                      AND da.filename NOT ILIKE '%%preliminary%%'
+                      AND da.individual_analysis IS NOT NULL
+                ) ranked
+                WHERE rn <= 2
+                """,
+                (PRIORITY_PATTERNS, loan_id),
+            )
+            for row in cur.fetchall():
+                if row['filename'] not in docs:
+                    docs[row['filename']] = row['analysis_text']
+
+        # Fill remaining slots with whatever else has an analysis, streamed
+        # through a server-side cursor so the big rows never sit in one
+        # client-side buffer (we usually stop well before the LIMIT).
+        with conn.cursor(name='docs_stream',
+                         cursor_factory=RealDictCursor) as scur:
+            scur.itersize = 5
+            scur.execute(
+                """
+                SELECT filename,
+                       LEFT(individual_analysis::text, 2000) AS analysis_text
+                FROM document_analysis
+                WHERE loan_id = %s
+                  AND individual_analysis IS NOT NULL
+                  AND status != 'duplicate'
+                ORDER BY id
+                LIMIT 30
+                """,
+                (loan_id,),
+            )
+            for row in scur:
+                if len(docs) >= 30:
+                    break
+                if row['filename'] not in docs:
+                    docs[row['filename']] = row['analysis_text']
+    finally:
+        conn.close()
+    print(f"✓ Loaded {len(docs)} source documents")
+    return docs
+
+
+def route_documents(attrs, source_docs):
+    """Drop documents no attribute in this batch can draw evidence from.
+
+    If any attribute has no routing hints we keep the full set — it may
+    need anything — so filtering is only ever a safe narrowing.
+    """
+    wanted = set()
+    for attr in attrs:
+        label = attr['label'].lower()
+        hints = [h for key, doc_hints in ATTR_DOC_HINTS.items()
+                 if key in label for h in doc_hints]
+        if not hints:
+            return source_docs
+        wanted.update(hints)
+    routed = {name: snippet for name, snippet in source_docs.items()
+              if any(h in name.lower() for h in wanted)}
+    if routed and len(routed) < len(source_docs):
+        print(f"✓ Routed prompt to {len(routed)}/{len(source_docs)} documents")
+        return routed
+    return source_docs
+
+
+_PROMPT_HEADER = """You are verifying extracted loan attributes against source documents.
+
+CRITICAL RULES:
+1. Use ONLY the source documents below as evidence.
+2. Show calculation steps for every derived value.
+3. Values must match exactly (to the cent / 0.01%).
+
+## SOURCE DOCUMENTS:
+"""
+
+_PROMPT_FOOTER = """
+## VERIFICATION RULES:
+- Mark verified only when a document states or derives the exact value.
+- Cite the document and page for every piece of evidence.
+
+## OUTPUT FORMAT:
+Return ONLY a JSON object:
+{"verifications": [{"attribute_id": ..., "attribute_label": "...",
+ "verified": true, "mismatch_reason": null, "evidence_file": "...",
+ "calculation_steps": [{"step_order": 1, "description": "...",
+ "value": "...", "document_name": "...", "page_number": null}]}]}
+"""
+
+
+def build_verification_prompt(attrs, source_docs):
+    """Interpolate the dynamic sections between the constant blocks."""
+    parts = [_PROMPT_HEADER]
+    for doc_name, doc_json in source_docs.items():
+        parts.append(f"\n### {doc_name}\n{doc_json}\n")
+
+    parts.append("\n## ATTRIBUTES TO VERIFY:\n")
+    for attr in attrs:
+        parts.append(f"\n### {attr['label']} (ID: {attr['id']})\n")
+        parts.append(f"- Expected Value: {attr['expected']}\n")
+        parts.append(f"- Definition: {attr['definition']}\n")
+
+    parts.append(_PROMPT_FOOTER)
+    return "".join(parts)
+
+
+def extract_json_object(response):
+    """Return the first top-level JSON object in the response, parsed.
+
+    Single forward scan with a brace-depth counter (string-aware), so a
+    tens-of-KB response is walked once instead of twice; orjson does the
+    actual decode.
+    """
+    start = response.find('{')
+    if start < 0:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(response)):
+        ch = response[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                return orjson.loads(response[start:i + 1])
+    return None
+
+
+def save_verification_results(loan_id, verifications):
+    """Replace stored results for the verified attributes.
+
+    Statements are batched with execute_batch so the whole write path is a
+    handful of round-trips instead of one per statement.
+    """
+    if not verifications:
+        return
+    # Batch-internal duplicate attribute_ids would violate the
+    # (loan_id, attribute_id) unique constraint after the delete;
+    # last occurrence wins.
+    verifications = list({v['attribute_id']: v for v in verifications}
+                         .values())
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            attr_ids = [v['attribute_id'] for v in verifications]
+            # Both tables cleared in one statement/round-trip; on a first
+            # verification these are cheap index probes that find nothing.
+            cur.execute(
+                """
+                WITH cleared_steps AS (
+                    DELETE FROM calculation_steps
+                    WHERE loan_id = %s AND attribute_id = ANY(%s)
+                )
+                DELETE FROM evidence_files
+                WHERE loan_id = %s AND attribute_id = ANY(%s)
+                """,
+                (loan_id, attr_ids, loan_id, attr_ids),
+            )
+
+            step_rows = [
+                (loan_id, v['attribute_id'], s.get('step_order', 1),
+                 s.get('description', ''), s.get('value', ''),
+                 s.get('document_name'), s.get('page_number'))
+                for v in verifications
+                for s in v.get('calculation_steps', [])
+            ]
+            if step_rows:
+                # COPY skips per-row parse/plan overhead entirely.
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                for row in step_rows:
+                    writer.writerow([r'\N' if v is None else v for v in row])
+                buf.seek(0)
+                cur.copy_expert(
+                    r"""
+                    COPY calculation_steps
+                        (loan_id, attribute_id, step_order, description,
+                         value, document_name, page_number)
+                    FROM STDIN WITH (FORMAT csv, NULL '\N')
+                    """,
+                    buf,
+                )
+
+            evidence_rows = [
+                (loan_id, v['attribute_id'], v.get('evidence_file'),
+                 v.get('evidence_file'),
+                 'verified' if v.get('verified') else 'not_verified',
+                 json.dumps({'verified': v.get('verified'),
+                             'mismatch_reason': v.get('mismatch_reason')}))
+                for v in verifications
+            ]
+            execute_batch(
+                cur,
+                """
+                INSERT INTO evidence_files
+                    (loan_id, attribute_id, file_name, file_path,
+                     verification_status, notes)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                """,
+                evidence_rows,
+                page_size=200,
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+    # One buffered write instead of a flush-per-line print loop.
+    lines = [f"  {'✓' if v.get('verified') else '✗'} "
+             f"{v.get('attribute_label', v['attribute_id'])}"
+             for v in verifications]
+    sys.stdout.write('\n'.join(lines) + '\n')
+    sys.stdout.flush()
+    return {'evidence_rows': len(evidence_rows), 'calc_steps': len(step_rows)}
+
+
+def run_verification(loan_id):
+    """Verify every pending attribute for the loan in one VLM call."""
+    print(f"=== Verification for loan {loan_id} ===")
+    # Independent loads on independent connections; overlap their round-trips.
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        attrs_future = ex.submit(load_attributes_to_verify, loan_id)
+        docs_future = ex.submit(load_source_documents, loan_id)
+        attrs = attrs_future.result()
+        source_docs = docs_future.result()
+
+    if not attrs:
+        print("✓ Nothing to verify")
+        return
+
+    prompt = build_verification_prompt(attrs, route_documents(attrs, source_docs))
+    client = VLMClient()
+    response = client.process_text(prompt)
+
+    result = extract_json_object(response)
+    if result is None:
+        print("✗ No JSON object in response")
+        return
+    return save_verification_results(loan_id, result.get('verifications', []))
+
+
+def run_verification_batch(loan_ids, max_workers=8):
+    """Verify many loans concurrently.
+
+    The per-loan work is dominated by the VLM round-trip, so threads give
+    near-linear wall-clock scaling; max_workers caps in-flight requests
+    below the API rate limit.
+    """
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futures = {ex.submit(run_verification, lid): lid for lid in loan_ids}
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"✗ Loan {futures[future]} failed: {e}")
+    print(f"=== Batch complete: {len(loan_ids) - len(failed)}/{len(loan_ids)} loans verified ===")
+    return failed
+
+
+def run(loan_id, force=False):
+    """Pipeline entry point."""
+    return run_verification(loan_id)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python run_verification.py <loan_id> [<loan_id> ...]")
+        sys.exit(1)
+    if len(sys.argv) > 2:
+        run_verification_batch(sys.argv[1:])
+    else:
+        run_verification(sys.argv[1])
@@ -0,0 +1,357 @@
+"""Second-pass verification for attributes that failed the first pass.
+
+Re-checks every not_verified attribute against the full document set,
+giving the model the already-verified values as cross-reference context.
+"""
+
+import json
+import sys
+
+from psycopg2.extras import Json, execute_values
+
+import llm_cache
+from db import get_db_connection
+from verify_attributes import ATTRIBUTE_DEFINITIONS
+from vlm_client import VLMClient
+
+_JSON_DECODER = json.JSONDecoder()
+
+# Set by run()/__main__; module-level so the helpers share it.
+LOAN_ID = None
+
+# Document classes that settle most second-pass attributes, best first.
+PRIORITY_PATTERNS = [
+    'mortgage_loan_statement',
+    'closing_disclosure',
+    'promissory_note',
+    'appraisal',
+    'hazard_insurance',
+]
+
+# Ranks filenames by PRIORITY_PATTERNS position; non-priority docs sort
+# last. Built once so load_source_documents is a single statement.
+_PRIORITY_CASE = 'CASE ' + ' '.join(
+    f"WHEN filename ILIKE '%%{p}%%' THEN {i}"
+    for i, p in enumerate(PRIORITY_PATTERNS)
+) + ' ELSE 99 END'
+
+
+def load_not_verified_attributes(conn=None):
+    """Load the attributes marked not_verified in the first pass."""
+    owned = conn is None
+    if owned:
+        conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT fa.id, fa.attribute_label, ed.extracted_value,
+                       ef.notes
+                FROM evidence_files ef
+                JOIN form_1008_attributes fa ON fa.id = ef.attribute_id
+                LEFT JOIN extracted_1008_data ed
+                  ON ed.attribute_id = fa.id AND ed.loan_id = ef.loan_id
+                WHERE ef.loan_id = %s
+                  AND ef.verification_status = 'not_verified'
+                ORDER BY fa.id
+                """,
+                (LOAN_ID,),
+            )
+            return [
+                {'id': row[0], 'label': row[1], 'expected': row[2],
+                 'first_pass_notes': row[3],
+                 'definition': ATTRIBUTE_DEFINITIONS.get(
+                     row[1], 'Standard 1008 field')}
+                for row in cur.fetchall()
+            ]
+    finally:
+        if owned:
+            conn.close()
+
+
+def load_verified_values(conn=None):
+    """Load already-verified values as cross-reference context."""
+    owned = conn is None
+    if owned:
+        conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT fa.attribute_label, ed.extracted_value
+                FROM evidence_files ef
+                JOIN form_1008_attributes fa ON fa.id = ef.attribute_id
+                JOIN extracted_1008_data ed
+                  ON ed.attribute_id = fa.id AND ed.loan_id = ef.loan_id
+                WHERE ef.loan_id = %s
+                  AND ef.verification_status = 'verified'
+                ORDER BY fa.id
+                """,
+                (LOAN_ID,),
+            )
+            return {label: value for label, value in cur.fetchall()}
+    finally:
+        if owned:
+            conn.close()
+
+
+def load_source_documents(conn=None):
+    """Load analysis text for priority documents, then the rest."""
+    owned = conn is None
+    if owned:
+        conn = get_db_connection()
+    docs = {}
+    try:
+        # Server-side cursor: rows stream in small batches instead of 30
+        # multi-KB snippets materializing in one fetchall.
+        with conn.cursor(name='second_pass_docs') as cur:
+            cur.itersize = 5
+            # One statement replaces the per-pattern fan-out plus the
+            # filler query: priority docs rank first, the rest fill up
+            # to the limit.
+            # Truncation happens in SQL: the server never ships more
+            # than the snippet, and Python never re-serializes the JSONB.
+            cur.execute(
+                f"""
+                SELECT filename,
+                       LEFT(analysis_text,
+                            CASE WHEN prio < 99 THEN 5000 ELSE 2000 END)
+                           AS snippet
+                FROM (
+                    SELECT filename, individual_analysis::text AS analysis_text,
+                           {_PRIORITY_CASE} AS prio
+                    FROM document_analysis
+                    WHERE loan_id = %s
+                      AND individual_analysis IS NOT NULL
+                      AND status != 'duplicate'
+                    ORDER BY prio, id
+                    LIMIT 30
+                ) ranked
+                """,
+                (LOAN_ID,),
+            )
+            for filename, snippet in cur:
+                if len(docs) >= 30:
+                    break
+                if filename not in docs:
+                    docs[filename] = snippet
+    finally:
+        if owned:
+            conn.close()
+    print(f"✓ Loaded {len(docs)} source documents")
+    return docs
+
+
+# Static prompt prefix: rules, the full attribute glossary, and the
+# output contract. Never varies per loan, so it is sent as its own
+# cache_control block and prefilled from cache on reruns.
+_STATIC_PREFIX = """You are re-verifying loan attributes that failed a first verification pass.
+
+CRITICAL RULES:
+1. Use ONLY the source documents below as evidence.
+2. The first pass may have missed evidence or used the wrong document —
+   look again, including derived/calculated values.
+3. Show calculation steps for every derived value.
+4. Values must match exactly (to the cent / 0.01%).
+5. If the evidence truly is not present, keep the attribute not_verified
+   and say why.
+
+## ATTRIBUTE DEFINITIONS:
+""" + "".join(
+    f"- {label}: {definition}\n"
+    for label, definition in ATTRIBUTE_DEFINITIONS.items()
+) + """
+## OUTPUT FORMAT:
+Return ONLY a JSON object:
+{"verifications": [{"attribute_id": ..., "attribute_label": "...",
+ "verified": true, "mismatch_reason": null, "evidence_file": "...",
+ "calculation_steps": [{"step_order": 1, "description": "...",
+ "value": "...", "document_name": "...", "page_number": null}]}]}
+"""
+
+
+# Hard ceiling for the source-documents section, in characters
+# (~4 chars per token, so roughly 7.5k tokens). Prefill cost and latency
+# scale linearly with prompt length; this keeps both bounded.
+DOC_CHAR_BUDGET = 30000
+
+
+def _budget_docs(source_docs):
+    """Trim snippets so the docs section stays within DOC_CHAR_BUDGET.
+
+    Docs arrive priority-ordered; each takes at most an even share of
+    the remaining budget, and anything a doc leaves unused rolls forward
+    to the ones after it.
+    """
+    total = sum(len(text) for text in source_docs.values())
+    if total <= DOC_CHAR_BUDGET:
+        return source_docs
+    budgeted = {}
+    remaining = DOC_CHAR_BUDGET
+    items = list(source_docs.items())
+    for i, (name, text) in enumerate(items):
+        share = remaining // (len(items) - i)
+        take = min(len(text), max(share, 500), remaining)
+        if take <= 0:
+            break
+        budgeted[name] = text[:take]
+        remaining -= take
+    print(f"→ Source docs trimmed {total} → "
+          f"{DOC_CHAR_BUDGET - remaining} chars "
+          f"(≈{(DOC_CHAR_BUDGET - remaining) // 4} tokens)")
+    return budgeted
+
+
+def build_prompt(attrs, verified_values, source_docs):
+    """Build the prompt as content blocks: static (cached) then dynamic."""
+    source_docs = _budget_docs(source_docs)
+    parts = ["## ALREADY-VERIFIED VALUES (cross-reference):\n"]
+    for label, value in verified_values.items():
+        parts.append(f"- {label}: {value}\n")
+
+    parts.append("\n## SOURCE DOCUMENTS:\n")
+    for doc_name, doc_json in source_docs.items():
+        parts.append(f"\n### {doc_name}\n{doc_json}\n")
+
+    parts.append("\n## ATTRIBUTES TO RE-VERIFY:\n")
+    for attr in attrs:
+        parts.append(f"\n### {attr['label']} (ID: {attr['id']})\n")
+        parts.append(f"- Expected Value: {attr['expected']}\n")
+        parts.append(f"- Definition: {attr['definition']}\n")
+        if attr.get('first_pass_notes'):
+            parts.append(f"- First-pass notes: {attr['first_pass_notes']}\n")
+
+    return [
+        {'type': 'text', 'text': _STATIC_PREFIX,
+         'cache_control': {'type': 'ephemeral'}},
+        {'type': 'text', 'text': "".join(parts)},
+    ]
+
+
+def update_database(verifications):
+    """Store the second-pass results.
+
+    One DELETE, one multi-row INSERT, and one multi-row UPDATE instead of
+    a statement per attribute and per step.
+    """
+    if not verifications:
+        return
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            attr_ids = [v['attribute_id'] for v in verifications]
+            cur.execute(
+                "DELETE FROM calculation_steps WHERE loan_id = %s AND attribute_id = ANY(%s)",
+                (LOAN_ID, attr_ids),
+            )
+
+            step_rows = [
+                (LOAN_ID, v['attribute_id'], s.get('step_order', 1),
+                 s.get('description', ''), s.get('value', ''),
+                 s.get('document_name'), s.get('page_number'))
+                for v in verifications
+                for s in v.get('calculation_steps', [])
+            ]
+            if step_rows:
+                execute_values(
+                    cur,
+                    """
+                    INSERT INTO calculation_steps
+                        (loan_id, attribute_id, step_order, description,
+                         value, document_name, page_number)
+                    VALUES %s
+                    """,
+                    step_rows,
+                    page_size=500,
+                )
+
+            # execute_values allows exactly one %s in the query, so the
+            # loan id rides along in every row instead of as a second
+            # parameter.
+            evidence_rows = [
+                (LOAN_ID, v['attribute_id'],
+                 'verified' if v.get('verified') else 'not_verified',
+                 v.get('evidence_file'),
+                 Json({'second_pass': True,
+                       'mismatch_reason': v.get('mismatch_reason')}))
+                for v in verifications
+            ]
+            execute_values(
+                cur,
+                """
+                UPDATE evidence_files ef
+                SET verification_status = u.status,
+                    file_name = COALESCE(u.evidence_file, ef.file_name),
+                    file_path = COALESCE(u.evidence_file, ef.file_path),
+                    notes = u.notes
+                FROM (VALUES %s)
+                    AS u (loan_id, attribute_id, status, evidence_file, notes)
+                WHERE ef.loan_id = u.loan_id
+                  AND ef.attribute_id = u.attribute_id
+                """,
+                evidence_rows,
+                template='(%s, %s, %s, %s, %s)',
+                page_size=500,
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+    for v in verifications:
+        emoji = '✓' if v.get('verified') else '✗'
+        print(f"  {emoji} {v.get('attribute_label', v['attribute_id'])}")
+    return {'second_pass_attrs': len(verifications)}
+
+
+def main():
+    print(f"=== Second-pass verification for loan {LOAN_ID} ===")
+    # One connection for all three loads: two fewer connect/auth cycles.
+    conn = get_db_connection()
+    try:
+        attrs = load_not_verified_attributes(conn)
+        if not attrs:
+            print("✓ Nothing left to re-verify")
+            return {'second_pass_attrs': 0}
+        verified_values = load_verified_values(conn)
+        source_docs = load_source_documents(conn)
+    finally:
+        conn.close()
+
+    prompt = build_prompt(attrs, verified_values, source_docs)
+    client = VLMClient(max_tokens=16000)
+    # At temperature 0 the response is deterministic; reruns with the
+    # same loan state come back from the disk cache instantly.
+    cache_key = None
+    response = None
+    if client.temperature == 0.0:
+        cache_key = llm_cache.make_key({'model': client.model,
+                                        'prompt': prompt})
+        response = llm_cache.get(cache_key)
+    if response is None:
+        response = client.process_text(prompt)
+        if cache_key is not None:
+            llm_cache.set(cache_key, response)
+
+    json_start = response.find('{')
+    if json_start < 0:
+        print("✗ No JSON object in response")
+        return
+    # raw_decode parses in place from the first brace: no reverse scan
+    # over the response and no substring copy.
+    result, _ = _JSON_DECODER.raw_decode(response, json_start)
+    return update_database(result.get('verifications', []))
+
+
+def run(loan_id, force=False):
+    """Pipeline entry point."""
+    global LOAN_ID
+    LOAN_ID = loan_id
+    return main()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python second_pass_verification.py <loan_id>")
+        sys.exit(1)
+    LOAN_ID = sys.argv[1]
+    main()
@@ -0,0 +1,338 @@
+"""Vision-based validation of MT360 snapshot fields against loan PDFs.
+
+Groups the MT360 fields into categories, picks the best source document
+for each category, and has Claude read the rendered pages to confirm or
+dispute each value.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import llm_cache
+from db import get_db_connection
+
+# pdf2image (PIL + a poppler probe) and bedrock_config (boto3) are slow
+# cold imports; they load lazily so importing this module just for
+# FIELD_CATEGORIES stays cheap.
+
+# Category → the MT360 fields it covers and the document types (best
+# first) that can evidence them.
+FIELD_CATEGORIES = {
+    'loan_terms': {
+        'fields': ['Note Rate', 'Loan Amount', 'Loan Term', 'Amortization Type'],
+        'documents': ['urla', 'promissory_note', 'closing_disclosure'],
+        'pages': [1, 2],
+    },
+    'payment': {
+        'fields': ['P&I', 'Proposed Monthly Payment', 'Qualifying Rate'],
+        'documents': ['urla', 'closing_disclosure', 'promissory_note'],
+        'pages': [1, 2],
+    },
+    'property': {
+        'fields': ['Property Address', 'Property Type', 'Occupancy',
+                   'Number of Units'],
+        'documents': ['urla', 'appraisal_report'],
+        'pages': [1],
+    },
+    'valuation': {
+        'fields': ['Appraised Value', 'Sales Price', 'LTV', 'CLTV'],
+        'documents': ['urla', 'appraisal_report', 'closing_disclosure'],
+        'pages': [1, 2, 3],
+    },
+    'borrower': {
+        'fields': ['Borrower Name', 'Co-Borrower Name', 'Citizenship'],
+        'documents': ['urla'],
+        'pages': [1],
+    },
+    'income': {
+        'fields': ['Total Monthly Income', 'Base Income', 'Other Income'],
+        'documents': ['urla', 'w2', 'paystub'],
+        'pages': [2, 3],
+    },
+    'liabilities': {
+        'fields': ['Total Monthly Obligations', 'DTI', 'Housing Ratio'],
+        'documents': ['urla', 'credit_report'],
+        'pages': [2, 3, 4],
+    },
+    'escrow': {
+        'fields': ['Hazard Insurance', 'Property Taxes', 'Mortgage Insurance',
+                   'HOA Dues'],
+        'documents': ['urla', 'closing_disclosure', 'hazard_insurance'],
+        'pages': [2, 3],
+    },
+    'declarations': {
+        'fields': ['Bankruptcy', 'Foreclosure', 'Primary Residence Intent'],
+        'documents': ['urla'],
+        'pages': [5, 6],
+    },
+}
+
+# Precomputed at import: frozen membership sets per category plus the
+# field → category reverse index, so assignment is one hash lookup.
+for _cfg in FIELD_CATEGORIES.values():
+    _cfg['fields_set'] = frozenset(_cfg['fields'])
+FIELD_TO_CATEGORY = {field: cat
+                     for cat, _cfg in FIELD_CATEGORIES.items()
+                     for field in _cfg['fields']}
+
+# Rendered pages memoized per (file, page): categories overwhelmingly
+# share the same URLA PDF, and rasterization dominates this module's CPU
+# time.
+_IMAGE_CACHE = {}
+
+# boto3 clients aren't guaranteed thread-safe, so each worker thread
+# builds its Bedrock client once and reuses it across categories.
+_BEDROCK_LOCAL = threading.local()
+
+
+def _bedrock():
+    client = getattr(_BEDROCK_LOCAL, 'client', None)
+    if client is None:
+        from bedrock_config import BedrockClient
+        client = BedrockClient(model=BEDROCK_MODEL_ID_FOR_VALIDATION)
+        _BEDROCK_LOCAL.client = client
+    return client
+
+
+_FENCED_JSON_RE = re.compile(
+    r"```(?:json)?\s*(\{.*?\}|\[.*?\])\s*```", re.DOTALL)
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _parse_response(response):
+    """Extract the JSON payload: fenced block first, raw_decode fallback."""
+    match = _FENCED_JSON_RE.search(response)
+    if match:
+        return json.loads(match.group(1))
+    starts = [i for i in (response.find('['), response.find('{')) if i >= 0]
+    if not starts:
+        return None
+    result, _ = _JSON_DECODER.raw_decode(response, min(starts))
+    return result
+
+
+DEFAULT_PAGES = (1, 2, 3)
+
+
+def pdf_to_base64_images(pdf_path, pages=DEFAULT_PAGES, dpi=120):
+    """Render the requested PDF pages to base64 JPEG strings.
+
+    `pages` are 1-based; negative values count from the end (-1 = last
+    page). Grayscale at 120 dpi reads fine for text-heavy forms and
+    shrinks the payload roughly 3x versus RGB at 150; bump dpi back up
+    if a document class starts misreading.
+    """
+    import base64
+    from io import BytesIO
+
+    from pdf2image import convert_from_path, pdfinfo_from_path
+
+    abspath = os.path.abspath(pdf_path)
+    mtime = os.path.getmtime(pdf_path)
+    if any(p < 0 for p in pages):
+        total = pdfinfo_from_path(pdf_path)['Pages']
+        pages = [p if p > 0 else total + 1 + p for p in pages]
+    pages = sorted(set(pages))
+
+    # Cached per page, so a page rendered for one category is reused by
+    # any other category that wants it.
+    missing = {p for p in pages
+               if (abspath, mtime, p, dpi) not in _IMAGE_CACHE}
+    if missing:
+        rendered = convert_from_path(pdf_path, dpi=dpi,
+                                     first_page=min(missing),
+                                     last_page=max(missing))
+        for number, page in enumerate(rendered, start=min(missing)):
+            if number not in missing:
+                continue
+            buffered = BytesIO()
+            # JPEG is several times smaller than PNG for scanned forms,
+            # which shrinks both the base64 work and the Bedrock payload.
+            page = page.convert('L')
+            page.save(buffered, format='JPEG', quality=80, optimize=True)
+            # getbuffer() hands b64encode a memoryview of the JPEG
+            # bytes instead of a full getvalue() copy.
+            _IMAGE_CACHE[(abspath, mtime, number, dpi)] = (
+                base64.b64encode(buffered.getbuffer()).decode('ascii'))
+
+    return [_IMAGE_CACHE[(abspath, mtime, p, dpi)] for p in pages
+            if (abspath, mtime, p, dpi) in _IMAGE_CACHE]
+
+
+@functools.lru_cache(maxsize=32)
+def _document_summary_cached(doc_dir, mtime):
+    """Listing + parsing done once per (doc_dir, mtime)."""
+    summary = {}
+    for fname in sorted(os.listdir(doc_dir)):
+        if not fname.lower().endswith('.pdf'):
+            continue
+        doc_type = fname.split('___')[0].rstrip('_0123456789').lower()
+        entry = summary.setdefault(doc_type, {'all': [], 'finals': []})
+        entry['all'].append(fname)
+        if 'final' in fname.lower():
+            entry['finals'].append(fname)
+    return summary
+
+
+def get_document_summary(doc_dir):
+    """Map document type → filenames (and final versions) in doc_dir."""
+    return _document_summary_cached(doc_dir, os.path.getmtime(doc_dir))
+
+
+def find_best_document(doc_types, doc_dir):
+    """Pick the best available PDF for a category, preferring finals."""
+    summary = get_document_summary(doc_dir)
+    for doc_type in doc_types:
+        entry = summary.get(doc_type)
+        if not entry:
+            continue
+        return os.path.join(doc_dir, (entry['finals'] or entry['all'])[-1])
+    return None
+
+
+def get_mt360_fields(loan_id):
+    """Load the MT360 snapshot values for the loan."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT fa.attribute_label, ed.extracted_value
+                FROM extracted_1008_data ed
+                JOIN form_1008_attributes fa ON fa.id = ed.attribute_id
+                WHERE ed.loan_id = %s
+                  AND ed.extracted_value IS NOT NULL
+                """,
+                (loan_id,),
+            )
+            return dict(cur.fetchall())
+    finally:
+        conn.close()
+
+
+def validate_field_category(category_name, config, fields_to_validate, doc_dir):
+    """Validate one pre-filtered category of fields against its document."""
+    if not fields_to_validate:
+        return []
+
+    pdf_path = find_best_document(config['documents'], doc_dir)
+    if pdf_path is None:
+        print(f"⚠ No document found for category '{category_name}'")
+        return []
+
+    images = pdf_to_base64_images(pdf_path,
+                                   pages=config.get('pages', DEFAULT_PAGES))
+
+    parts = [f"You are validating '{category_name}' fields from a loan system against the attached document pages.\n\n",
+             "## FIELDS TO VALIDATE:\n"]
+    for field, value in fields_to_validate.items():
+        parts.append(f"- {field}: {value}\n")
+    parts.append("""
+For each field, read the document and report whether it matches.
+Return ONLY a JSON array:
+[{"field": "...", "mt360_value": "...", "document_value": "...",
+  "match": true, "notes": null}]
+""")
+    prompt = "".join(parts)
+
+    content = [
+        {'type': 'image',
+         'source': {'type': 'base64', 'media_type': 'image/jpeg',
+                    'data': img}}
+        for img in images
+    ]
+    content.append({'type': 'text', 'text': prompt})
+
+    client = _bedrock()
+    # Deterministic call: identical payloads are served from disk.
+    # Images are keyed by their digests to keep the key material small.
+    cache_key = None
+    response = None
+    if client.temperature == 0.0:
+        cache_key = llm_cache.make_key({
+            'model': client.model,
+            'prompt': prompt,
+            'images': [hashlib.sha256(img.encode()).hexdigest()
+                       for img in images],
+        })
+        response = llm_cache.get(cache_key)
+    if response is None:
+        response = client.invoke(content)
+        if cache_key is not None:
+            llm_cache.set(cache_key, response)
+
+    results = _parse_response(response)
+    if not isinstance(results, list):
+        print(f"✗ No JSON array in response for '{category_name}'")
+        return []
+    for r in results:
+        r['category'] = category_name
+    return results
+
+
+# The validator runs against the strongest vision model available.
+BEDROCK_MODEL_ID_FOR_VALIDATION = os.environ.get(
+    'MODDA_VALIDATOR_MODEL', 'anthropic.claude-opus-4-5-v1:0')
+
+
+def smart_validate_urla(loan_id, doc_dir):
+    """Validate every MT360 field category for the loan."""
+    print(f"=== Smart validation for loan {loan_id} ===")
+    mt360_fields = get_mt360_fields(loan_id)
+    if not mt360_fields:
+        print("✗ No MT360 fields found")
+        return []
+
+    # Intersect fields with each category up front: categories with no
+    # overlap never touch the filesystem or a worker thread.
+    pending = []
+    for name, cfg in FIELD_CATEGORIES.items():
+        fields_set = cfg['fields_set']
+        cat_fields = {k: v for k, v in mt360_fields.items()
+                      if k in fields_set}
+        if cat_fields:
+            pending.append((name, cfg, cat_fields))
+    if not pending:
+        print("✗ No MT360 fields overlap any category")
+        return []
+
+    # Pre-render each category's document once, serially: the cache then
+    # serves every worker without poppler runs racing each other.
+    for _, cfg, _fields in pending:
+        pdf_path = find_best_document(cfg['documents'], doc_dir)
+        if pdf_path:
+            pdf_to_base64_images(pdf_path, pages=cfg.get('pages', DEFAULT_PAGES))
+
+    # Each category is one independent Bedrock round-trip; running them
+    # together turns sum-of-calls latency into max-of-calls.
+    all_results = []
+    with ThreadPoolExecutor(max_workers=len(pending)) as ex:
+        futures = {
+            ex.submit(validate_field_category, name, cfg, cat_fields,
+                      doc_dir): name
+            for name, cfg, cat_fields in pending
+        }
+        for future in as_completed(futures):
+            print(f"✓ Validated '{futures[future]}'")
+            all_results.extend(future.result())
+
+    matches = sum(1 for r in all_results if r.get('match'))
+    print(f"=== {matches}/{len(all_results)} fields match ===")
+    for r in all_results:
+        if not r.get('match'):
+            print(f"  ✗ {r.get('field')}: MT360={r.get('mt360_value')!r} "
+                  f"doc={r.get('document_value')!r} ({r.get('notes')})")
+    return all_results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: python smart_validator.py <loan_id> <doc_dir>")
+        sys.exit(1)
+    smart_validate_urla(sys.argv[1], sys.argv[2])
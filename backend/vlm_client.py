@@ -0,0 +1,57 @@
+"""Thin wrapper around the Anthropic SDK used by the verification scripts."""
+
+import os
+
+from anthropic import Anthropic
+
+DEFAULT_MODEL = os.environ.get('MODDA_VLM_MODEL', 'claude-opus-4-5')
+
+
+class VLMClient:
+    """Text/vision client for verification prompts."""
+
+    def __init__(self, model=DEFAULT_MODEL, max_tokens=8000, temperature=0.0):
+        self.client = Anthropic(api_key=os.environ.get('ANTHROPIC_API_KEY'))
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+
+    def process_text(self, prompt):
+        """Send a prompt and return the model's text response.
+
+        `prompt` may be a plain string or a list of content blocks, so
+        callers can mark static blocks with cache_control and pay prefill
+        for them only once per cache window.
+        """
+        message = self.client.messages.create(
+            model=self.model,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            messages=[{'role': 'user', 'content': prompt}],
+        )
+        return message.content[0].text
+
+    def process_structured(self, prompt, tool_name, input_schema):
+        """Send a prompt and force the response through a tool schema.
+
+        `prompt` may be a plain string or a list of content blocks (for
+        prompt-cached layering). Returns the tool input as an
+        already-parsed dict, so callers get well-formed output without
+        salvaging JSON out of prose.
+        """
+        message = self.client.messages.create(
+            model=self.model,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            tools=[{
+                'name': tool_name,
+                'description': f'Submit the {tool_name} result.',
+                'input_schema': input_schema,
+            }],
+            tool_choice={'type': 'tool', 'name': tool_name},
+            messages=[{'role': 'user', 'content': prompt}],
+        )
+        for block in message.content:
+            if block.type == 'tool_use':
+                return block.input
+        return {}